@@ -1,33 +1,192 @@
 # Ключевые импорты
+from cachetools import LRUCache
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import Response
-from markitdown import MarkItDown, UnsupportedFormatException, FileConversionException
-from urllib.parse import unquote, urlparse
+from markitdown import MarkItDown, StreamInfo, UnsupportedFormatException, FileConversionException
+from urllib.parse import unquote
 import asyncio
+import codecs
 import logging
 import os
-import tempfile
-import requests
+import re
+import time
+import httpx
 from io import BytesIO
-import chardet
 
 # Константа для fallback на Playwright при малом размере контента
 PLAYWRIGHT_MIN_CONTENT_SIZE = 1024  # 1 KB - если контента меньше, пробуем Playwright
 
+# Константы конфигурации
+REQUEST_TIMEOUT = 30  # Таймаут для HTTP запроса (секунды)
+CONVERSION_TIMEOUT = 25  # Таймаут для конвертации (секунды)
+MAX_CONTENT_SIZE = 10 * 1024 * 1024  # Максимальный размер контента (10 MB)
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # Размер чанка при скачивании (64 KB)
+HTTP_RETRIES = 2  # Количество повторов при ошибке соединения или временной ошибке сервера
+HTTP_RETRY_BACKOFF = 0.05  # Базовая задержка между повторами, удваивается с каждой попыткой (секунды)
+HTTP_KEEPALIVE_EXPIRY = 30  # Сколько держать простаивающее соединение открытым для повторных запросов к тому же хосту (секунды)
+CONVERSION_WORKERS = os.cpu_count() or 1  # Количество потоков для конвертации
+MAX_INFLIGHT = int(os.getenv('MAX_INFLIGHT', str(2 * CONVERSION_WORKERS)))  # Максимум одновременно обрабатываемых запросов
+INFLIGHT_WAIT_TIMEOUT = 1  # Сколько ждать свободного слота перед ответом 503 (секунды)
+CHARSET_SAMPLE_SIZE = 64 * 1024  # Размер начала документа для поиска <meta charset> (64 KB)
+RESPONSE_CACHE_MAX_SIZE = 64 * 1024 * 1024  # Суммарный размер markdown в кэше ответов в UTF-8 (64 MB)
+RESPONSE_CACHE_MAX_ITEM_SIZE = 1024 * 1024  # Результаты больше этого размера в UTF-8 не кэшируются (1 MB)
+RESPONSE_CACHE_TTL = 300  # Время, в течение которого результат отдается из кэша без запроса к источнику (секунды)
+
+# User-Agent для имитации браузера
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
+# Уровень логирования задается через LOG_LEVEL (по умолчанию WARNING, подробный лог запросов - DEBUG)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'WARNING').upper()
+
+logging.basicConfig(level=LOG_LEVEL)
+logger = logging.getLogger(__name__)
+
+# Конвертер MarkItDown создается один раз при старте и переиспользуется всеми запросами
+converter = MarkItDown()
+
+# Кэш ответов: URL -> (markdown, ETag, Last-Modified, время сохранения, размер markdown в UTF-8)
+# Используется только из event loop, поэтому блокировка не нужна
+# Размер кэша ограничен суммарным размером markdown в байтах (вычисляется один раз при записи), а не числом записей
+response_cache: LRUCache[str, tuple[str, str, str, float, int]] = LRUCache(
+    maxsize=RESPONSE_CACHE_MAX_SIZE, getsizeof=lambda entry: entry[4]
+)
+
+
+# Жизненный цикл приложения: общий HTTP-клиент (keep-alive между запросами) и пул потоков конвертации
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Транспорт с пулом соединений и повтором при ошибках установки соединения
+    transport = httpx.AsyncHTTPTransport(
+        limits=httpx.Limits(max_keepalive_connections=100, max_connections=200, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+        retries=HTTP_RETRIES,
+    )
+    app.state.http = httpx.AsyncClient(
+        headers={'User-Agent': USER_AGENT},
+        timeout=REQUEST_TIMEOUT,
+        transport=transport,
+        follow_redirects=True,
+    )
+    # Семафор, ограничивающий число одновременно обрабатываемых запросов
+    app.state.inflight = asyncio.Semaphore(MAX_INFLIGHT)
+    # Ограниченный пул потоков для CPU-bound конвертации MarkItDown
+    app.state.conversion_pool = ThreadPoolExecutor(max_workers=CONVERSION_WORKERS, thread_name_prefix="markitdown")
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+        app.state.conversion_pool.shutdown(wait=False, cancel_futures=True)
+
+
 # Инициализация FastAPI приложения
 app = FastAPI(
     title="URL to Markdown API",
     description="API service to convert urls to markdown using MarkItDown",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
-# Константы конфигурации
-REQUEST_TIMEOUT = 30  # Таймаут для HTTP запроса (секунды)
-CONVERSION_TIMEOUT = 25  # Таймаут для конвертации (секунды)
-MAX_CONTENT_SIZE = 10 * 1024 * 1024  # Максимальный размер контента (10 MB)
 
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+# Системные файлы, которые браузеры запрашивают автоматически, и поддерживаемые протоколы
+_SKIP_PATHS = frozenset({"favicon.ico", "robots.txt", "sitemap.xml"})
+_SCHEMES = ("http://", "https://")
+
+
+@lru_cache(maxsize=4096)
+def _parse_url(raw: str) -> tuple[str, httpx.URL]:
+    """Декодирует URL из percent-encoding, добавляет протокол и возвращает (URL, разобранный httpx.URL)"""
+    decoded_url = unquote(raw)
+
+    # Автоматическое добавление протокола, если его нет
+    if not decoded_url.startswith(_SCHEMES):
+        prefix = "" if decoded_url.startswith("www.") else "www."
+        decoded_url = f"https://{prefix}{decoded_url}"
+
+    # Разбираем URL тем же парсером, что использует HTTP-клиент (с IDNA-кодированием домена),
+    # и передаем готовый объект в запрос без повторного разбора
+    try:
+        return decoded_url, httpx.URL(decoded_url)
+    except httpx.InvalidURL as e:
+        raise ValueError(f"Invalid URL: {e}") from e
+
+
+# BOM-маркеры и <meta charset> / <meta http-equiv="Content-Type"> для определения кодировки HTML
+_BOMS = (
+    (codecs.BOM_UTF8, 'utf-8'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+# Тег <meta> ограничен по длине и ищется без вложенного перебора, чтобы незакрытые теги не вызывали квадратичный backtracking
+_META_TAG_RE = re.compile(rb'<meta[^>]{0,512}', re.IGNORECASE)
+_CHARSET_ATTR_RE = re.compile(rb'charset\s*=\s*["\']?\s*([a-zA-Z0-9_.:-]+)', re.IGNORECASE)
+
+
+# Типы контента, которые MarkItDown не умеет конвертировать (изображения, аудио и архивы поддерживаются)
+_UNSUPPORTED_MIME_PREFIXES = (
+    "video/",
+    "font/",
+    "application/font-",
+    "application/x-font-",
+    "application/x-msdownload",
+    "application/x-executable",
+    "application/vnd.android.package-archive",
+)
+
+# MIME-тип и charset из заголовка Content-Type за один проход
+_CONTENT_TYPE_RE = re.compile(r'^\s*([^;\s]*)(?:.*?;\s*charset\s*=\s*["\']?([^"\';\s]+))?', re.IGNORECASE)
+
+
+def _normalize_charset(charset: str | None) -> str | None:
+    """Приводит имя кодировки к каноническому виду; неизвестную кодировку оставляем на автоопределение MarkItDown"""
+    try:
+        return codecs.lookup(charset).name if charset else None
+    except LookupError:
+        return None
+
+
+@lru_cache(maxsize=256)
+def _parse_content_type(content_type: str) -> tuple[str, str | None]:
+    """Разбирает заголовок Content-Type и возвращает (MIME-тип, кодировка)"""
+    match = _CONTENT_TYPE_RE.match(content_type)
+    return match.group(1).lower(), _normalize_charset(match.group(2))
+
+
+def _sniff_charset(charset: str | None, content: bytearray) -> str | None:
+    """Определяет кодировку HTML: по BOM, из заголовка или по <meta charset> в начале документа"""
+    # BOM имеет приоритет над заголовком, как в алгоритме определения кодировки HTML
+    for bom, encoding in _BOMS:
+        if content.startswith(bom):
+            return encoding
+    if charset:
+        return charset
+    for tag in _META_TAG_RE.finditer(content, 0, CHARSET_SAMPLE_SIZE):
+        match = _CHARSET_ATTR_RE.search(tag.group())
+        if match:
+            return _normalize_charset(match.group(1).decode('ascii'))
+    return None
+
+
+# Временные ошибки сервера, при которых запрос повторяется
+_RETRY_STATUSES = frozenset({502, 503, 504})
+
+
+@asynccontextmanager
+async def _stream_with_retries(client: httpx.AsyncClient, url: httpx.URL, headers: dict[str, str]):
+    """Открывает потоковый GET-запрос, повторяя его с экспоненциальной задержкой при ответах 502/503/504"""
+    for attempt in range(HTTP_RETRIES + 1):
+        response = await client.send(client.build_request("GET", url, headers=headers), stream=True)
+        if response.status_code not in _RETRY_STATUSES or attempt == HTTP_RETRIES:
+            break
+        logger.debug("Upstream returned %d, retrying: %s", response.status_code, url)
+        await response.aclose()
+        await asyncio.sleep(HTTP_RETRY_BACKOFF * 2 ** attempt)
+
+    try:
+        yield response
+    finally:
+        await response.aclose()
 
 
 # Эндпоинт для проверки работоспособности сервиса
@@ -40,27 +199,21 @@ async def healthz():
 @app.get("/{url:path}")
 async def convert_url(url: str, request: Request):
     # Извлекаем URL из пути запроса (поддержка query параметров)
-    url = (
-        request.url.path[1:]
-        if not request.url.query
-        else request.url.path[1:] + "?" + request.url.query
-    )
-    logger.info("Received URL path: %s", url)
-    
-    # Обработка пустого запроса
-    if url is None or url == "":
+    query = request.url.query
+    url = f"{request.url.path[1:]}?{query}" if query else request.url.path[1:]
+
+    # Обработка пустого запроса (до логирования и декодирования)
+    if not url:
         return Response(
             content="Welcome to URL to Markdown API\nUsage: https://markdown.nimk.ir/YOUR_URL",
             media_type="text/plain",
         )
 
-    # Декодируем URL из формата percent-encoding
-    decoded_url = unquote(url)
-    logger.info("Decoded URL: %s", decoded_url)
+    logger.debug("Received URL path: %s", url)
 
     # Проверка на системные файлы (favicon.ico и т.д.)
-    if decoded_url in ("favicon.ico", "robots.txt", "sitemap.xml"):
-        logger.info("Skipping system file: %s", decoded_url)
+    if url in _SKIP_PATHS:
+        logger.debug("Skipping system file: %s", url)
         return Response(
             content="Not Found",
             media_type="text/plain",
@@ -68,19 +221,33 @@ async def convert_url(url: str, request: Request):
         )
 
     try:
-        # Автоматическое добавление протокола, если его нет
-        if not decoded_url.startswith(("http://", "https://")):
-            if decoded_url.startswith("www."):
-                decoded_url = "https://" + decoded_url
-            else:
-                decoded_url = "https://www." + decoded_url
+        # Декодируем URL и добавляем протокол (результат кэшируется для повторяющихся URL)
+        decoded_url, target_url = _parse_url(url)
+        logger.debug("Decoded URL: %s", decoded_url)
+
+        # Проверяем кэш ответов: свежий результат возвращаем без обращения к сети и без ожидания слота
+        cached = response_cache.get(decoded_url)
+        if cached is not None and time.monotonic() - cached[3] < RESPONSE_CACHE_TTL:
+            logger.debug("Serving cached markdown for: %s", decoded_url)
+            return Response(content=cached[0], media_type="text/plain")
+
+        # Ограничиваем число одновременно обрабатываемых запросов: при перегрузке быстро отвечаем 503
+        inflight: asyncio.Semaphore = request.app.state.inflight
+        try:
+            async with asyncio.timeout(INFLIGHT_WAIT_TIMEOUT):
+                await inflight.acquire()
+        except TimeoutError:
+            logger.warning("Too many requests in flight, rejecting URL: %s", decoded_url)
+            raise HTTPException(
+                status_code=503, detail="Server is busy. Please try again later."
+            )
 
         try:
-            logger.info("Starting conversion for URL: %s", decoded_url)
+            logger.debug("Starting conversion for URL: %s", decoded_url)
 
             # Асинхронная функция конвертации
             async def _convert() -> str:
-                # Блокировка для потокового выполнения (для синхронных операций requests)
+                # Синхронные части (конвертация, Playwright) выполняются в отдельном потоке
                 
                 def _run_playwright(url: str) -> str | None:
                     """Выполняет конвертацию через Playwright для динамических сайтов"""
@@ -100,90 +267,124 @@ async def convert_url(url: str, request: Request):
                             html = page.content()
                             browser.close()
                         
-                        # Конвертируем полученный HTML через MarkItDown
-                        instance = MarkItDown()
-                        temp_file = None
-                        try:
-                            with tempfile.NamedTemporaryFile(mode='w', suffix='.html', delete=False, encoding='utf-8') as f:
-                                f.write(html)
-                                temp_file = f.name
-                            conversion_result = instance.convert_local(temp_file)
-                            return conversion_result.text_content
-                        finally:
-                            if temp_file and os.path.exists(temp_file):
-                                os.unlink(temp_file)
+                        # Конвертируем полученный HTML через MarkItDown в памяти, без временного файла
+                        conversion_result = converter.convert_stream(
+                            BytesIO(html.encode('utf-8')),
+                            stream_info=StreamInfo(extension='.html', charset='utf-8'),
+                        )
+                        return conversion_result.text_content
                     except Exception as e:
                         logger.error("Playwright conversion failed: %s", str(e))
                         return None
                 
-                def _run():
-                    # Валидация URL: проверка наличия домена
-                    parsed = urlparse(decoded_url)
-                    if not parsed.netloc:
-                        raise ValueError("Invalid URL: no domain specified")
-                    
-                    logger.info("Downloading content from: %s", decoded_url)
-                    
-                    # Создаем сессию с User-Agent для имитации браузера
-                    session = requests.Session()
-                    session.headers.update({
-                        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-                    })
-                    
-                    # Скачиваем контент с потоковой обработкой и ограничением размера
-                    response = session.get(decoded_url, timeout=REQUEST_TIMEOUT, stream=True)
-                    response.raise_for_status()
-                    
-                    # Читаем контент чанками с проверкой лимита размера
-                    content = b''
-                    for chunk in response.iter_content(chunk_size=8192):
-                        content += chunk
-                        if len(content) > MAX_CONTENT_SIZE:
-                            raise ValueError(f"Content size exceeds maximum limit ({MAX_CONTENT_SIZE / 1024 / 1024} MB)")
-                    
-                    logger.info("Downloaded %d bytes, content-type: %s", len(content), response.headers.get('content-type', 'unknown'))
-                    
-                    # Определяем тип контента
-                    content_type = response.headers.get('content-type', '')
-                    
-                    # Логируем первые 200 символов контента для отладки
-                    if len(content) > 0:
+                def _run(content: bytearray, mimetype: str, charset: str | None) -> str:
+                    # Логируем первые 200 символов контента для отладки (декодируем только при включенном DEBUG)
+                    if len(content) > 0 and logger.isEnabledFor(logging.DEBUG):
                         preview = content[:min(200, len(content))].decode('utf-8', errors='replace')
-                        logger.info("Content preview: %s", preview)
-                    
-                    # Инициализация конвертера MarkItDown
-                    instance = MarkItDown()
+                        logger.debug("Content preview: %s", preview)
                     
-                    if 'text/html' in content_type:
+                    if mimetype == 'text/html':
                         # Для HTML передаем байты напрямую MarkItDown
-                        # MarkItDown сам определит кодировку из HTML
-                        logger.info("Converting HTML from bytes directly")
-                        conversion_result = instance.convert_stream(BytesIO(content))
+                        # Кодировку берем из заголовка, BOM или <meta charset> (без нее HtmlConverter считает документ UTF-8)
+                        charset = _sniff_charset(charset, content)
+                        logger.debug("Converting HTML from bytes directly (charset: %s)", charset or 'auto')
+                        conversion_result = converter.convert_stream(BytesIO(content), stream_info=StreamInfo(extension='.html', charset=charset))
                     else:
                         # Для других типов используем потоковое чтение
-                        logger.info("Converting from stream (content-type: %s)", content_type)
-                        conversion_result = instance.convert_stream(BytesIO(content))
+                        logger.debug("Converting from stream (content-type: %s)", mimetype)
+                        conversion_result = converter.convert_stream(BytesIO(content))
                     
                     markdown_content = conversion_result.text_content
-                    logger.info("Markdown content size: %d bytes", len(markdown_content))
-                    
-                    # Если markdown слишком маленький, пробуем Playwright как fallback
-                    if len(markdown_content) < PLAYWRIGHT_MIN_CONTENT_SIZE and 'text/html' in content_type:
-                        logger.info("Markdown size (%d bytes) is below threshold (%d bytes), attempting Playwright fallback", len(markdown_content), PLAYWRIGHT_MIN_CONTENT_SIZE)
-                        playwright_result = _run_playwright(decoded_url)
-                        if playwright_result:
-                            logger.info("Playwright fallback successful")
-                            return playwright_result
-                        logger.warning("Playwright fallback failed")
-                    
-                    logger.info("Conversion completed successfully")
+                    logger.debug("Markdown content size: %d bytes", len(markdown_content))
                     return markdown_content
 
-                # Выполняем синхронную функцию в отдельном потоке
-                return await asyncio.to_thread(_run)
+                # Валидация URL: проверка наличия домена
+                if not target_url.host:
+                    raise ValueError("Invalid URL: no domain specified")
+
+                # Устаревшую запись кэша проверяем условным запросом
+                request_headers = {}
+                if cached is not None:
+                    cached_markdown, etag, last_modified, _, cached_size = cached
+                    if etag:
+                        request_headers['If-None-Match'] = etag
+                    if last_modified:
+                        request_headers['If-Modified-Since'] = last_modified
+
+                logger.debug("Downloading content from: %s", decoded_url)
+
+                # Скачиваем контент асинхронно через общий клиент с потоковой обработкой и ограничением размера
+                client: httpx.AsyncClient = request.app.state.http
+                async with _stream_with_retries(client, target_url, request_headers) as response:
+                    # Контент не изменился: возвращаем закэшированный markdown без конвертации
+                    if response.status_code == 304 and cached is not None:
+                        logger.debug("Content not modified, serving cached markdown for: %s", decoded_url)
+                        response_cache[decoded_url] = (cached_markdown, etag, last_modified, time.monotonic(), cached_size)
+                        return cached_markdown
+
+                    response.raise_for_status()
+
+                    # Определяем тип контента и валидаторы для условных запросов
+                    content_type = response.headers.get('content-type', '')
+                    etag = response.headers.get('etag', '')
+                    last_modified = response.headers.get('last-modified', '')
+                    mimetype, charset = _parse_content_type(content_type)
+
+                    # Типы, для которых у MarkItDown нет конвертера, отклоняем до скачивания тела
+                    if mimetype.startswith(_UNSUPPORTED_MIME_PREFIXES):
+                        raise UnsupportedFormatException(f"Content type {mimetype} cannot be converted to Markdown")
+
+                    # По Content-Length отклоняем слишком большой ответ до чтения тела
+                    content_length = response.headers.get('content-length', '')
+                    declared_size = int(content_length) if content_length.isdigit() else 0
+                    if declared_size > MAX_CONTENT_SIZE:
+                        raise ValueError(f"Content size exceeds maximum limit ({MAX_CONTENT_SIZE / 1024 / 1024} MB)")
+
+                    # Без сжатия размер тела известен заранее: выделяем буфер один раз.
+                    # Для сжатого ответа Content-Length не равен размеру распакованных данных, поэтому буфер растет по мере чтения
+                    if response.headers.get('content-encoding', 'identity') == 'identity':
+                        content = bytearray(declared_size)
+                    else:
+                        content = bytearray()
+
+                    # Читаем контент чанками с проверкой лимита размера.
+                    # Присваивание среза копирует чанк на место в выделенный буфер и расширяет его, если данных больше заявленного
+                    size = 0
+                    async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                        end = size + len(chunk)
+                        if end > MAX_CONTENT_SIZE:
+                            raise ValueError(f"Content size exceeds maximum limit ({MAX_CONTENT_SIZE / 1024 / 1024} MB)")
+                        content[size:end] = chunk
+                        size = end
+                    # Отбрасываем неиспользованный хвост, если данных пришло меньше заявленного
+                    del content[size:]
+
+                logger.debug("Downloaded %d bytes, content-type: %s", len(content), content_type or 'unknown')
+
+                # Конвертацию (CPU-bound) выполняем в ограниченном пуле потоков, чтобы всплеск запросов не занял все потоки
+                loop = asyncio.get_running_loop()
+                markdown_content = await loop.run_in_executor(request.app.state.conversion_pool, _run, content, mimetype, charset)
+
+                # Если markdown слишком маленький, пробуем Playwright как fallback
+                if len(markdown_content) < PLAYWRIGHT_MIN_CONTENT_SIZE and mimetype == 'text/html':
+                    logger.info("Markdown size (%d bytes) is below threshold (%d bytes), attempting Playwright fallback", len(markdown_content), PLAYWRIGHT_MIN_CONTENT_SIZE)
+                    # Playwright в основном ждет сеть, поэтому не занимает пул конвертации
+                    playwright_result = await asyncio.to_thread(_run_playwright, decoded_url)
+                    if playwright_result:
+                        logger.info("Playwright fallback successful")
+                        markdown_content = playwright_result
+                    else:
+                        logger.warning("Playwright fallback failed")
+
+                logger.debug("Conversion completed successfully")
+                markdown_size = len(markdown_content.encode('utf-8'))
+                if markdown_size <= RESPONSE_CACHE_MAX_ITEM_SIZE:
+                    response_cache[decoded_url] = (markdown_content, etag, last_modified, time.monotonic(), markdown_size)
+                return markdown_content
 
             # Выполняем конвертацию с таймаутом
-            text_content = await asyncio.wait_for(_convert(), timeout=CONVERSION_TIMEOUT)
+            async with asyncio.timeout(CONVERSION_TIMEOUT):
+                text_content = await _convert()
             return Response(content=text_content, media_type="text/plain")
         
         # Обработка ошибок конвертации
@@ -197,12 +398,12 @@ async def convert_url(url: str, request: Request):
             raise HTTPException(
                 status_code=400, detail=f"URL conversion failed: {str(e)}"
             )
-        except asyncio.TimeoutError:
+        except TimeoutError:
             logger.error("Conversion timeout for URL: %s", decoded_url)
             raise HTTPException(
                 status_code=504, detail="Conversion timed out. Please try again later."
             )
-        except requests.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error("HTTP request failed for URL %s: %s", decoded_url, str(e))
             raise HTTPException(
                 status_code=502, detail=f"Failed to fetch URL: {str(e)}"
@@ -217,6 +418,8 @@ async def convert_url(url: str, request: Request):
             raise HTTPException(
                 status_code=500, detail=f"Internal server error: {str(e)}"
             )
+        finally:
+            inflight.release()
     
     # Повторное возбуждение HTTPException (не обрабатывать их как 400)
     except HTTPException: